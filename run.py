@@ -1,81 +1,263 @@
-#!/usr/local/bin/python
+#!/usr/bin/env python3
 """Analyze a set of samples with HUMAnN2."""
 
 import os
+import re
+import csv
+import glob
+import hashlib
+import gzip
 import json
 import uuid
 import boto3
 import shutil
+import botocore.config
 import logging
 import argparse
+import threading
 import subprocess
+import urllib.request
+from boto3.s3.transfer import TransferConfig
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared settings for all S3 transfers: parallel multipart uploads and
+# downloads, instead of shelling out to the AWS CLI for each file.
+# The 1MB io_chunksize keeps the number of read()/write() syscalls per
+# transfer low (the boto3 default is 256KB)
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16,
+    io_chunksize=1024 * 1024,
+    use_threads=True)
+
+# Settings for the individual files within the reference database sync:
+# the sync already runs 32 files at a time, so each file gets a smaller
+# multipart fan-out (multi-GB chocophlan/uniref files still split into
+# parallel ranged GETs) to keep the total number of streams bounded
+DB_SYNC_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=4,
+    io_chunksize=1024 * 1024,
+    use_threads=True)
+
+
+# Format used for every log handler
+LOG_FMT = '%(asctime)s %(levelname)-8s [run.py] %(message)s'
+
+
+class ListLogHandler(logging.Handler):
+    """Collect formatted log records in an in-memory list.
+
+    Only records emitted by the thread that created the handler are
+    collected, so the per-sample logs don't pick up messages from the
+    fetch threads that are downloading other samples in parallel.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+        self.thread = threading.get_ident()
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.lines.append(self.format(record))
+
+
+def split_s3_path(s3_path):
+    """Split an s3:// path into (bucket, key)."""
+    bucket = s3_path[5:].split('/')[0]
+    key = '/'.join(s3_path[5:].split('/')[1:])
+    return bucket, key
+
+
+# One S3 client shared by every upload, download, and existence check:
+# each boto3.client() call re-loads botocore's service model
+_S3_CLIENT = None
+
+
+def s3_client():
+    """Return the shared S3 client, creating it on first use."""
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        # The connection pool covers the worst-case fan-out of the
+        # database sync (32 files in flight, each with up to 4 multipart
+        # streams); an undersized pool makes urllib3 churn connections
+        # on exactly the hottest path. Adaptive retries back off under
+        # S3 throttling instead of failing the whole run
+        _S3_CLIENT = boto3.client('s3', config=botocore.config.Config(
+            max_pool_connections=128,
+            retries={'max_attempts': 10, 'mode': 'adaptive'}))
+    return _S3_CLIENT
+
+
+def prefetched_sra_path(accession, folders):
+    """Find a previously prefetched .sra file for an accession."""
+    for folder in folders:
+        if folder is None:
+            continue
+        # prefetch writes either <folder>/<accession>.sra or
+        # <folder>/<accession>/<accession>.sra, depending on the version
+        for fp in [os.path.join(folder, accession + ".sra"),
+                   os.path.join(folder, accession, accession + ".sra")]:
+            if os.path.exists(fp):
+                return fp
+    return None
 
 
-def get_sra(accession, temp_folder):
+def get_sra(accession, temp_folder, threads=1, sra_dir=None,
+            sra_tool="fasterq-dump"):
     """Get the FASTQ for an SRA accession via ENA."""
     local_path = os.path.join(temp_folder, accession + ".fastq")
-    # Download from ENA via FTP
-    # See https://www.ebi.ac.uk/ena/browse/read-download for URL format
-    url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq"
-    folder1 = accession[:6]
-    url = "{}/{}".format(url, folder1)
-    if len(accession) > 9:
-        if len(accession) == 10:
-            folder2 = "00" + accession[-1]
-        elif len(accession) == 11:
-            folder2 = "0" + accession[-2:]
-        elif len(accession) == 12:
-            folder2 = accession[-3:]
-        else:
-            logging.info("This accession is too long: " + accession)
-            assert len(accession) <= 12
-        url = "{}/{}".format(url, folder2)
-    # Add the accession to the URL
-    url = "{}/{}/{}".format(url, accession, accession)
-    logging.info("Base info for downloading from ENA: " + url)
-    # There are three possible file endings
+    # If the .sra file was already prefetched (by --batch-prefetch in
+    # __main__), skip the ENA probe entirely -- otherwise the same
+    # reads would be downloaded a second time
+    sra_fp = prefetched_sra_path(accession, [sra_dir, temp_folder])
+    # There are three possible file endings on ENA
     file_endings = ["_1.fastq.gz", "_2.fastq.gz", ".fastq.gz"]
-    # Try to download each file
-    for end in file_endings:
-        run_cmds(["curl",
-                  "-o", os.path.join(temp_folder, accession + end),
-                  url + end], catchExcept=True)
+    if sra_fp is None:
+        # Download from ENA via FTP
+        # See https://www.ebi.ac.uk/ena/browse/read-download for URL format
+        url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq"
+        folder1 = accession[:6]
+        url = "{}/{}".format(url, folder1)
+        if len(accession) > 9:
+            if len(accession) == 10:
+                folder2 = "00" + accession[-1]
+            elif len(accession) == 11:
+                folder2 = "0" + accession[-2:]
+            elif len(accession) == 12:
+                folder2 = accession[-3:]
+            else:
+                logging.info("This accession is too long: " + accession)
+                assert len(accession) <= 12
+            url = "{}/{}".format(url, folder2)
+        # Add the accession to the URL
+        url = "{}/{}/{}".format(url, accession, accession)
+        logging.info("Base info for downloading from ENA: " + url)
+
+        # ENA serves each shard on an independent connection, so download
+        # all three concurrently rather than paying for them back-to-back.
+        # aria2c additionally splits each shard across parallel segments,
+        # which hides the per-stream congestion-window ramp on WAN links
+        aria2c = shutil.which("aria2c")
+
+        def download_shard(end):
+            if aria2c is not None:
+                run_cmds([aria2c, "-x", "4", "-s", "4", "-k", "1M",
+                          "-d", temp_folder,
+                          "-o", accession + end,
+                          url + end], catchExcept=True)
+            else:
+                run_cmds(["curl",
+                          "-o", os.path.join(temp_folder, accession + end),
+                          url + end], catchExcept=True)
+
+        with ThreadPoolExecutor(max_workers=len(file_endings)) as pool:
+            for f in [pool.submit(download_shard, end)
+                      for end in file_endings]:
+                f.result()
     # If none of those URLs downloaded, fall back to trying NCBI
-    if any([os.path.exists("{}/{}{}".format(temp_folder, accession, end))
+    if sra_fp is None and \
+       any([os.path.exists("{}/{}{}".format(temp_folder, accession, end))
             for end in file_endings]):
-        # Combine them all into a single file
-        logging.info("Combining into a single FASTQ file")
-        with open(local_path, "wt") as fo:
-            cmd = "gunzip -c {}/{}*fastq.gz".format(temp_folder, accession)
-            gunzip = subprocess.Popen(cmd, shell=True, stdout=fo)
-            gunzip.wait()
-
-        # Clean up the temporary files
-        logging.info("Cleaning up temporary files")
-        for end in file_endings:
-            fp = "{}/{}{}".format(temp_folder, accession, end)
-            if os.path.exists(fp):
-                os.unlink(fp)
+        # Gzip streams can simply be concatenated, and both MetaPhlAn2
+        # and HUMAnN2 read gzipped FASTQ directly, so the shards are
+        # joined as-is without ever inflating the data to disk
+        logging.info("Combining into a single gzipped FASTQ file")
+        shards = sorted(glob.glob(
+            os.path.join(temp_folder, accession + "*fastq.gz")))
+        local_path = os.path.join(temp_folder, accession + ".fastq.gz")
+        if shards == [local_path]:
+            # The single unpaired shard is already the combined file
+            pass
+        else:
+            with open(local_path + ".temp", "wb") as fo:
+                for shard in shards:
+                    with open(shard, "rb") as fi:
+                        shutil.copyfileobj(fi, fo, length=1 << 20)
+                    os.unlink(shard)
+            os.replace(local_path + ".temp", local_path)
     else:
-        logging.info("No files found on ENA, trying SRA")
-        run_cmds([
-            "fastq-dump",
-            "--split-files",
-            "--outdir",
-            temp_folder, accession])
-
-        # Combine any multiple files that were found
-        with open(local_path + ".temp", "wt") as fo:
-            cmd = "cat {}/{}*fastq".format(temp_folder, accession)
-            cat = subprocess.Popen(cmd, shell=True, stdout=fo)
-            cat.wait()
-
-        if os.path.exists(local_path + ".temp"):
-            run_cmds(["mv", local_path + ".temp", local_path])
+        # Use the .sra file from the batch prefetch in __main__ if it
+        # exists, otherwise download it now
+        if sra_fp is None:
+            logging.info("No files found on ENA, trying SRA")
+            run_cmds(["prefetch",
+                      "--output-directory", temp_folder, accession],
+                     capture=False)
+            sra_fp = prefetched_sra_path(accession, [temp_folder])
+            msg = "prefetch did not download {}".format(accession)
+            assert sra_fp is not None, msg
+        # Clamp the conversion threads: more than 8 yields no further
+        # speedup, and never use more threads than the host has cores
+        dump_threads = min(threads, os.cpu_count() or 1, 8)
+        if sra_tool == "parallel-fastq-dump":
+            # Fallback for sites where fasterq-dump can't be used: chop
+            # the .sra into ranges and fork one fastq-dump per range
+            run_cmds(["parallel-fastq-dump",
+                      "--sra-id", sra_fp,
+                      "--threads", str(dump_threads),
+                      "--outdir", temp_folder,
+                      "--split-3",
+                      "--tmpdir", temp_folder],
+                     capture=False)
+        else:
+            # fasterq-dump is multi-threaded, unlike the deprecated
+            # fastq-dump. Keep the scratch space (-t) on the same volume
+            # as the output so the final rename doesn't copy across
+            # devices
+            run_cmds(["fasterq-dump",
+                      "--threads", str(dump_threads),
+                      "--split-3",
+                      "--skip-technical",
+                      "--outdir", temp_folder,
+                      "-t", temp_folder,
+                      sra_fp],
+                     capture=False)
+
+        # fasterq-dump writes <accession>.fastq, or <accession>_1.fastq /
+        # <accession>_2.fastq for paired-end data
+        dumped = sorted(glob.glob(
+            os.path.join(temp_folder, accession + "*.fastq")))
 
         # Check to see if the file was downloaded
         msg = "File could not be downloaded from SRA: {}".format(accession)
-        assert os.path.exists(local_path), msg
+        assert len(dumped) > 0, msg
+
+        # The .sra file (which can run to tens of GB) is no longer
+        # needed once the FASTQ exists
+        os.unlink(sra_fp)
+        sra_dirname = os.path.dirname(sra_fp)
+        if os.path.basename(sra_dirname) == accession:
+            shutil.rmtree(sra_dirname, ignore_errors=True)
+
+        # Avoid writing a second full copy of the FASTQ to disk: a single
+        # output file is renamed into place, and only paired-end outputs
+        # need to be concatenated
+        if dumped == [local_path]:
+            pass
+        elif len(dumped) == 1:
+            os.replace(dumped[0], local_path)
+        else:
+            logging.info("Combining {} files into one".format(len(dumped)))
+            with open(local_path + ".temp", "wb") as fo:
+                for fp in dumped:
+                    with open(fp, "rb") as fi:
+                        shutil.copyfileobj(fi, fo, length=1 << 20)
+                    os.unlink(fp)
+            os.replace(local_path + ".temp", local_path)
 
     # Return the path to the file
     logging.info("Done fetching " + accession)
@@ -98,37 +280,156 @@ def sra_url(accession):
     return url
 
 
-def run_cmds(commands, retry=0, catchExcept=False):
+# Append-only file descriptor for the log file, opened in __main__ and
+# shared by subprocesses whose output is not captured
+LOG_FD = None
+
+# Absolute paths of executables, resolved once per tool so that each
+# invocation skips the PATH search
+_BIN_PATHS = {}
+
+
+def resolve_bin(name):
+    """Resolve an executable name to its absolute path (cached)."""
+    if name not in _BIN_PATHS:
+        _BIN_PATHS[name] = shutil.which(name) or name
+    return _BIN_PATHS[name]
+
+
+def spawn_wait(argv, stdout_fd):
+    """Run a command with posix_spawn, sending all output to a fd."""
+    # posix_spawn skips the fork() page-table copy of this (boto3-heavy)
+    # parent process, and the kernel writes the tool's output straight
+    # to the fd with no Python in the loop. os.posix_spawn was added in
+    # Python 3.8, so fall back to Popen on older interpreters
+    if not hasattr(os, "posix_spawn"):
+        return subprocess.Popen(
+            argv, stdout=stdout_fd, stderr=subprocess.STDOUT).wait()
+    pid = os.posix_spawn(
+        argv[0], argv, os.environ,
+        file_actions=[(os.POSIX_SPAWN_DUP2, stdout_fd, 1),
+                      (os.POSIX_SPAWN_DUP2, stdout_fd, 2)])
+    _, status = os.waitpid(pid, 0)
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return -os.WTERMSIG(status)
+
+
+def run_cmds(commands, retry=0, catchExcept=False, capture=True, cpus=None,
+             log_fd=None):
     """Run commands and write out the log, combining STDOUT & STDERR."""
+    # Commands are always argv lists, never shell strings: no /bin/sh
+    # fork, no shell glob expansion, no metacharacter interpretation
+    assert isinstance(commands, list), commands
+    # Resolve the executable once per tool instead of once per call
+    commands = [resolve_bin(commands[0])] + commands[1:]
     logging.info("Commands:")
     logging.info(' '.join(commands))
-    p = subprocess.Popen(commands,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    stdout, stderr = p.communicate()
-    exitcode = p.wait()
-    if stdout:
-        logging.info("Standard output of subprocess:")
-        for line in stdout.split('\n'):
-            logging.info(line)
-    if stderr:
-        logging.info("Standard error of subprocess:")
-        for line in stderr.split('\n'):
-            logging.info(line)
+    # Pinning to a CPU set is done with sched_setaffinity in the child
+    # (between fork and exec), which needs no external binary -- the
+    # busybox base image does not ship util-linux taskset
+    preexec = None
+    if cpus is not None:
+        preexec = lambda: os.sched_setaffinity(0, cpus)
+    # Callers can direct the un-captured output to their own fd (e.g. a
+    # per-sample file); the global log file is the default
+    if log_fd is None:
+        log_fd = LOG_FD
+    if capture is False and log_fd is not None:
+        # Tools with large progress output (humann2, metaphlan2) write
+        # straight to the log file: the kernel does the demux and the
+        # bytes never pass through Python at all
+        if preexec is None:
+            exitcode = spawn_wait(commands, log_fd)
+        else:
+            # preexec_fn needs the fork()-based Popen path
+            exitcode = subprocess.Popen(commands,
+                                        stdout=log_fd,
+                                        stderr=subprocess.STDOUT,
+                                        preexec_fn=preexec).wait()
+    else:
+        p = subprocess.Popen(commands,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             bufsize=1,
+                             universal_newlines=True,
+                             preexec_fn=preexec)
+        # Stream the combined output line-by-line as it is produced, so
+        # that memory usage stays constant no matter how much the
+        # subprocess writes (communicate() would buffer all of it)
+        for line in p.stdout:
+            logging.info(line.rstrip())
+        exitcode = p.wait()
 
     # Check the exit code
     if exitcode != 0 and retry > 0:
         msg = "Exit code {}, retrying {} more times".format(exitcode, retry)
         logging.info(msg)
-        run_cmds(commands, retry=retry - 1)
+        return run_cmds(commands, retry=retry - 1, catchExcept=catchExcept,
+                        capture=capture, cpus=cpus, log_fd=log_fd)
     elif exitcode != 0 and catchExcept:
         msg = "Exit code was {}, but we will continue anyway"
         logging.info(msg.format(exitcode))
     else:
         assert exitcode == 0, "Exit code {}".format(exitcode)
 
-
-def get_reads_from_url(input_str, temp_folder):
+    # Return the exit code so that callers can act on it directly
+    return exitcode
+
+
+def ranged_http_download(url, local_path, n_chunks=8):
+    """Download a URL with parallel HTTP range requests."""
+    # Find the total size, and make sure the server supports ranges
+    req = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(req, timeout=60) as resp:
+        size = int(resp.headers.get("Content-Length", 0))
+        accept_ranges = resp.headers.get("Accept-Ranges", "")
+    if size == 0 or accept_ranges != "bytes":
+        return False
+
+    logging.info("Downloading {:,} bytes in {} ranges".format(size,
+                                                              n_chunks))
+    # Download into a .part file, then rename into place once every
+    # range has landed, so a failed download never leaves a partial
+    # file at local_path for the fallback downloader to trip over
+    part_path = local_path + ".part"
+    # Pre-allocate the file, then write each range at its own offset
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, size)
+        chunk = (size + n_chunks - 1) // n_chunks
+
+        def fetch_range(start):
+            end = min(start + chunk, size) - 1
+            hdr = {"Range": "bytes={}-{}".format(start, end)}
+            r = urllib.request.Request(url, headers=hdr)
+            with urllib.request.urlopen(r, timeout=300) as resp:
+                # A 200 means the server ignored the Range header
+                assert resp.status == 206, "Server does not support ranges"
+                offset = start
+                while True:
+                    buf = resp.read(1 << 20)
+                    if len(buf) == 0:
+                        break
+                    os.pwrite(fd, buf, offset)
+                    offset += len(buf)
+                assert offset == end + 1, "Incomplete range from server"
+
+        with ThreadPoolExecutor(max_workers=n_chunks) as pool:
+            starts = range(0, size, chunk)
+            for f in [pool.submit(fetch_range, s) for s in starts]:
+                f.result()
+    except BaseException:
+        os.close(fd)
+        os.unlink(part_path)
+        raise
+    os.close(fd)
+    os.replace(part_path, local_path)
+    return True
+
+
+def get_reads_from_url(input_str, temp_folder, threads=1, sra_dir=None,
+                       sra_tool="fasterq-dump"):
     """Get a set of reads from a URL."""
     logging.info("Using reads from {}".format(input_str))
 
@@ -153,21 +454,44 @@ def get_reads_from_url(input_str, temp_folder):
     # Get files from AWS S3
     if input_str.startswith('s3://'):
         logging.info("Getting reads from S3")
-        run_cmds(['aws', 's3', 'cp', '--quiet', '--sse', 'AES256',
-                  input_str, temp_folder + '/'])
+        bucket, key = split_s3_path(input_str)
+        client = s3_client()
+        client.download_file(bucket, key, local_path,
+                             Config=S3_TRANSFER_CONFIG)
         return local_path
 
     # Get files from an FTP server
     elif input_str.startswith('ftp://'):
         logging.info("Getting reads from FTP")
-        run_cmds(['wget', '-P', temp_folder, input_str])
+        # ENA serves its FTP tree over HTTPS as well, which supports
+        # parallel range requests for much better WAN throughput
+        https_url = "https://" + input_str[len("ftp://"):]
+        try:
+            fetched = ranged_http_download(https_url, local_path)
+        except Exception:
+            logging.info("Ranged HTTPS download failed")
+            fetched = False
+        if fetched is False:
+            # Fall back to FTP, segmented across parallel connections
+            # when aria2c is available. Pin the output name in both
+            # cases, so that the download can never be auto-renamed
+            # (e.g. to <filename>.1) if something is already at the
+            # local path
+            aria2c = shutil.which("aria2c")
+            if aria2c is not None:
+                run_cmds([aria2c, "-x", "8", "-s", "8", "-k", "1M",
+                          "-d", temp_folder, "-o", filename,
+                          "--allow-overwrite=true", input_str])
+            else:
+                run_cmds(['wget', '-O', local_path, input_str])
         return local_path
 
     # Get files from SRA
     elif input_str.startswith('sra://'):
         accession = filename
         logging.info("Getting reads from SRA: " + accession)
-        local_path = get_sra(accession, temp_folder)
+        local_path = get_sra(accession, temp_folder, threads=threads,
+                             sra_dir=sra_dir, sra_tool=sra_tool)
 
         return local_path
 
@@ -175,26 +499,89 @@ def get_reads_from_url(input_str, temp_folder):
         raise Exception("Did not recognize prefix for sample: " + input_str)
 
 
-def get_reference_database(ref_db, temp_folder):
+def hardlink_mirror(src_folder, dest_folder):
+    """Mirror a folder tree using hardlinks (same filesystem only)."""
+    for dirpath, dirnames, filenames in os.walk(src_folder):
+        rel = os.path.relpath(dirpath, src_folder)
+        if rel == ".":
+            dest_dir = dest_folder
+        else:
+            dest_dir = os.path.join(dest_folder, rel)
+        os.makedirs(dest_dir, exist_ok=True)
+        for name in filenames:
+            os.link(os.path.join(dirpath, name),
+                    os.path.join(dest_dir, name))
+
+
+def get_reference_database(ref_db, temp_folder, keep_db=False):
     """Get a reference database."""
 
     # Get files from AWS S3
     if ref_db.startswith('s3://'):
         logging.info("Getting reference database from S3: " + ref_db)
 
-        # Save the database to a local folder with a random string prefix
-        random_string = uuid.uuid4()
-        local_fp = os.path.join(temp_folder, "{}.db".format(random_string))
-
-        assert os.path.exists(local_fp) is False
+        # Save the database to a local folder named for the hash of the
+        # database URL, so that a copy left behind by a previous
+        # invocation on this host can be found and reused
+        db_hash = hashlib.sha256(ref_db.encode()).hexdigest()
+        local_fp = os.path.join(temp_folder, "{}.db".format(db_hash))
+
+        # List the objects up-front: the ETags are needed both to
+        # validate any cached copy and to record what was downloaded
+        bucket, prefix = split_s3_path(ref_db)
+        client = s3_client()
+        paginator = client.get_paginator('list_objects_v2')
+        etags = {}
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            etags.update({obj['Key']: obj['ETag']
+                          for obj in page.get('Contents', [])})
+        assert len(etags) > 0, "No objects found under " + ref_db
+
+        # A manifest of {key: etag} marks a completely downloaded
+        # database; reuse it only if it still matches what is on S3
+        manifest_fp = os.path.join(local_fp, ".manifest.json")
+        if os.path.exists(manifest_fp):
+            with open(manifest_fp, "rt") as f:
+                cached = json.load(f)
+            if cached == etags:
+                logging.info("Using cached database at " + local_fp)
+                # Keep the cached copy for future invocations
+                return local_fp, False
+            logging.info("Cached database is stale, downloading again")
+
+        # Anything already at local_fp is stale or incomplete: clear it
+        # before re-downloading, so that files whose keys were removed
+        # from S3 cannot survive the re-sync. HUMAnN2 reads whole
+        # directories, so a leftover file would silently be used -- and
+        # the new manifest would then validate the mixed tree as a
+        # cache hit on every later invocation
+        if os.path.exists(local_fp):
+            shutil.rmtree(local_fp)
 
         logging.info("Saving database to " + local_fp)
-        # Using `sync` so that the entire folder structure is copied
-        run_cmds(['aws', 's3', 'sync', '--quiet', '--sse', 'AES256',
-                  ref_db, local_fp])
 
-        # If the database was downloaded from S3, delete it when finished
-        delete_db_when_finished = True
+        def download_key(key):
+            rel = key[len(prefix):].lstrip('/')
+            dest = os.path.join(local_fp, rel)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            client.download_file(bucket, key, dest,
+                                 Config=DB_SYNC_TRANSFER_CONFIG)
+
+        # S3 throughput scales roughly linearly with concurrency up to
+        # ~32 streams, and the database sync is the cold-start bottleneck
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            for f in [pool.submit(download_key, key) for key in etags]:
+                f.result()
+
+        # Record what was downloaded, marking the copy as complete
+        with open(manifest_fp, "wt") as fo:
+            json.dump(etags, fo)
+
+        # If the database was downloaded from S3, delete it when
+        # finished -- unless the caller asked to keep it, in which case
+        # the manifest written above lets the next invocation on this
+        # host skip the download entirely
+        delete_db_when_finished = not keep_db
 
         return local_fp, delete_db_when_finished
 
@@ -203,79 +590,185 @@ def get_reference_database(ref_db, temp_folder):
         logging.info("Getting reference database from local path: " + ref_db)
         assert os.path.exists(ref_db)
 
-        # Don't delete this database when finished
-        delete_db_when_finished = False
-
-        return ref_db, delete_db_when_finished
+        # Mirror the database into the temp folder with hardlinks
+        # (near-zero cost on the same filesystem), so that any indexes
+        # HUMAnN2 writes next to the database land in scratch space
+        # instead of polluting the (possibly read-only) source
+        db_hash = hashlib.sha256(ref_db.encode()).hexdigest()
+        local_fp = os.path.join(temp_folder, "{}.db".format(db_hash))
+        try:
+            hardlink_mirror(ref_db, local_fp)
+        except OSError:
+            # Different filesystem -- just use the source in place
+            logging.info("Could not hardlink the database, using source")
+            if os.path.exists(local_fp):
+                shutil.rmtree(local_fp)
+            return ref_db, False
+
+        # Deleting the mirror at the end only removes the links
+        return local_fp, True
 
 
 def return_results(out, output_fp, temp_folder):
     """Write out the final results as a JSON object in the output folder."""
-    # Make a temporary file
-    temp_fp = os.path.join(temp_folder, 'temp.json')
-    with open(temp_fp, 'wt') as fo:
-        json.dump(out, fo)
-    # Compress the output
-    run_cmds(['gzip', temp_fp])
-    temp_fp = temp_fp + '.gz'
+    # Serialize once (orjson is several times faster than the stdlib
+    # json module, when it is available) and stream the bytes through
+    # the compressor in a single pass with no intermediate file
+    temp_fp = os.path.join(temp_folder, 'temp.json.gz')
+    if orjson is not None:
+        payload = orjson.dumps(out)
+    else:
+        payload = json.dumps(out).encode()
+    pigz = shutil.which("pigz")
+    if igzip is not None:
+        # ISA-L's accelerated deflate is several times faster than
+        # zlib, with no subprocess fork at all
+        with igzip.open(temp_fp, "wb", compresslevel=1) as fo:
+            fo.write(payload)
+    elif pigz is not None:
+        # pigz compresses on multiple cores
+        with open(temp_fp, "wb") as fgz:
+            p = subprocess.Popen([pigz, "-c"],
+                                 stdin=subprocess.PIPE,
+                                 stdout=fgz)
+            p.stdin.write(payload)
+            p.stdin.close()
+            assert p.wait() == 0, "pigz failed"
+    else:
+        with gzip.open(temp_fp, "wb", compresslevel=1) as fo:
+            fo.write(payload)
 
     if output_fp.startswith('s3://'):
         # Copy to S3
-        run_cmds(['aws', 's3', 'cp', '--quiet', '--sse', 'AES256',
-                  temp_fp, output_fp])
+        bucket, key = split_s3_path(output_fp)
+        client = s3_client()
+        client.upload_file(temp_fp, bucket, key,
+                           Config=S3_TRANSFER_CONFIG,
+                           ExtraArgs={'ServerSideEncryption': 'AES256'})
     else:
-        # Copy to local folder
-        run_cmds(['mv', temp_fp, output_fp])
+        # Move to the local folder: os.replace is atomic on the same
+        # filesystem, while shutil.move copies across devices
+        out_dir = os.path.dirname(output_fp) or "."
+        if os.stat(out_dir).st_dev == os.stat(temp_folder).st_dev:
+            os.replace(temp_fp, output_fp)
+        else:
+            shutil.move(temp_fp, output_fp)
+
+
+def drop_page_cache(fp):
+    """Tell the kernel that a file's cached pages are no longer needed."""
+    try:
+        fd = os.open(fp, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        # Purely advisory -- never fail the run over it
+        pass
+
+
+# Short file suffixes that HUMAnN2 doesn't recognize, with or without a
+# trailing .gz, and the canonical name for each
+FILE_ENDING_RE = re.compile(r'\.(fna|fa|fq)(\.gz)?$')
+FILE_ENDING_MAP = {"fna": "fasta", "fa": "fasta", "fq": "fastq"}
 
 
 def control_file_endings(input_file):
     """HUMAnN2 has a quirk in that it requires a defined file suffix."""
-    for suffix, replacement in [('.fna', '.fasta'),
-                                ('.fa', '.fasta'),
-                                ('.fq', '.fastq'),
-                                ('.fna.gz', '.fasta.gz'),
-                                ('.fa.gz', '.fasta.gz'),
-                                ('.fq.gz', '.fastq.gz')]:
-        if input_file.endswith(suffix):
-            new_file = input_file.replace(suffix, replacement)
-            os.rename(input_file, new_file)
-            return(new_file)
+    # A single anchored regex replaces the previous chain of endswith
+    # checks, which also tested '.fna' before '.fna.gz' and so renamed
+    # gzipped files to a bare '.fasta' suffix
+    match = FILE_ENDING_RE.search(input_file)
+    if match:
+        suffix = "." + FILE_ENDING_MAP[match.group(1)] + (match.group(2)
+                                                          or "")
+        new_file = input_file[:match.start()] + suffix
+        os.replace(input_file, new_file)
+        return new_file
     return input_file
 
 
-def run(input_str,            # ID for single sample to process
-        read_prefix,          # Name of the sample
-        db_fp,                # Local path to DB
-        db_url,               # URL of ref DB, used for logging
-        metaphlan_db_prefix,  # Relative path to the MetaPhlAn database
-        output_fp,            # Place to put results
-        temp_folder,          # Temporary folder
-        threads):             # Number of threads
-    """Run HUMAnN2 on a single sample and return the results."""
-
-    # Check to see if the output already exists, if so, skip this sample
+def list_existing_outputs(output_fps):
+    """List the S3 keys that already exist among the output paths."""
+    existing = set()
+    s3_outputs = [split_s3_path(output_fp)
+                  for output_fp in output_fps
+                  if output_fp.startswith('s3://')]
+    if len(s3_outputs) == 0:
+        return existing
+    client = s3_client()
+
+    # For a handful of outputs, one O(1) HEAD per key beats listing the
+    # whole output folder, which may hold thousands of unrelated keys
+    if len(s3_outputs) <= 3:
+        for bucket, key in s3_outputs:
+            try:
+                client.head_object(Bucket=bucket, Key=key)
+                existing.add((bucket, key))
+            except client.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != '404':
+                    raise
+        return existing
+
+    # For larger batches, group the outputs by their containing folder
+    # and list each folder just once
+    prefixes = set((bucket, os.path.dirname(key))
+                   for bucket, key in s3_outputs)
+    paginator = client.get_paginator('list_objects_v2')
+    for bucket, prefix in prefixes:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            existing.update((bucket, obj['Key'])
+                            for obj in page.get('Contents', []))
+    return existing
+
+
+def output_exists(output_fp, s3_keys):
+    """Check to see if the output already exists (S3 or local)."""
     if output_fp.startswith('s3://'):
-        # Check S3
-        logging.info("Making sure that the output path doesn't already exist")
-        bucket = output_fp[5:].split('/')[0]
-        prefix = '/'.join(output_fp[5:].split('/')[1:])
-        client = boto3.client('s3')
-        results = client.list_objects(Bucket=bucket, Prefix=prefix)
-        if 'Contents' in results:
-            logging.info("Output already exists ({})".format(output_fp))
-            return
+        # Check against the keys already listed from S3
+        return split_s3_path(output_fp) in s3_keys
     else:
         # Check local filesystem
-        if os.path.exists(output_fp):
-            logging.info("Output already exists ({})".format(output_fp))
-            return
+        return os.path.exists(output_fp)
+
 
+def fetch_reads(input_str, temp_folder, threads=1, sra_dir=None,
+                sra_tool="fasterq-dump"):
+    """Fetch the reads for a single sample into the temp folder."""
     # Get the sample
-    input_file = get_reads_from_url(input_str, temp_folder)
+    input_file = get_reads_from_url(input_str, temp_folder, threads=threads,
+                                    sra_dir=sra_dir, sra_tool=sra_tool)
 
     # If the file ends with some non-standard file endings, correct them
     input_file = control_file_endings(input_file)
 
+    return input_file
+
+
+def run(input_file,           # Local path to the reads for this sample
+        input_str,            # ID for single sample to process
+        db_fp,                # Local path to DB
+        db_url,               # URL of ref DB, used for logging
+        metaphlan_db_prefix,  # Relative path to the MetaPhlAn database
+        temp_folder,          # Temporary folder
+        threads):             # Number of threads
+    """Run HUMAnN2 on a single sample and return the results."""
+
+    # Capture the log messages for this sample in memory, rather than
+    # re-reading the log file from disk at the end (which would also
+    # pick up the logs from every previous sample)
+    sample_log = ListLogHandler()
+    sample_log.setFormatter(logging.Formatter(LOG_FMT))
+    logging.getLogger().addHandler(sample_log)
+
+    # The un-captured MetaPhlAn2/HUMAnN2 output (alignment rates, reads
+    # processed, etc.) goes to a per-sample file, read back in one pass
+    # below so the diagnostics end up in the result JSON's logs
+    tool_log_fp = os.path.join(temp_folder, "tools.log.txt")
+    tool_fd = os.open(tool_log_fp,
+                      os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
     # Location of MetaPhlAn2 database
     mpa_db_fp = os.path.join(db_fp, metaphlan_db_prefix)
     # Location to write MetaPhlAn2 output
@@ -287,13 +780,22 @@ def run(input_str,            # ID for single sample to process
               "--bowtie2db", mpa_db_fp,          # Bowtie2 database
               "--mpa_pkl", mpa_db_fp + ".pkl",   # Database metadata
               input_file,                        # Input file
-              mpa_out])                          # Output file
+              mpa_out],                          # Output file
+             capture=False, log_fd=tool_fd)
     logging.info("Done")
 
     logging.info("Running HUMAnN2")
     # Folders within the HUMAnN2 database folder
     nuc_db = os.path.join(db_fp, "chocophlan")
     prot_db = os.path.join(db_fp, "uniref")
+    # Pin HUMAnN2 (and the bowtie2/diamond processes it spawns) to a
+    # fixed set of cores, so the scheduler doesn't migrate the
+    # memory-bound aligner threads across NUMA nodes. Pick the cores
+    # from this process's own affinity mask rather than assuming
+    # 0..N-1: under a cgroup cpuset (common on batch schedulers) the
+    # low-numbered CPUs may not be allowed at all
+    allowed = sorted(os.sched_getaffinity(0))
+    cores = allowed[:min(threads, len(allowed))]
     # Run HUMAnN2
     run_cmds(["humann2",
               "--input", input_file,             # Input file
@@ -301,86 +803,112 @@ def run(input_str,            # ID for single sample to process
               "--nucleotide-database", nuc_db,   # Chocophlan database
               "--protein-database", prot_db,     # UniRef database
               "--threads", str(threads),         # Multithreading
-              "--taxonomic-profile", mpa_out])   # MetaPhlAn2 output
+              "--taxonomic-profile", mpa_out],   # MetaPhlAn2 output
+             capture=False, cpus=cores, log_fd=tool_fd)
     logging.info("Done")
 
+    # The input FASTQ has now been read for the last time -- drop it
+    # from the page cache so the GBs it pushed through don't evict the
+    # reference database for the next sample
+    drop_page_cache(input_file)
+
     # Collect the output
     out = read_humann2_output_files(temp_folder)
     # Get the MetaPhlAn2 output as well
-    out["metaphlan2"] = read_tsv(mpa_out, header=["taxa", "percent"])
+    out["metaphlan2"] = read_tsv(mpa_out, header=["taxa", "percent"],
+                                 numeric=["percent"])
 
     # Add the runtime parameters
     out["parameters"] = {"db": db_url, "input": input_str, "threads": threads}
 
-    # Read in the logs
-    logging.info("Reading in the logs")
-    out["logs"] = open(log_fp, 'rt').readlines()
+    # Mark the columnar table layout so downstream readers can tell it
+    # apart from the older one-dict-per-row outputs
+    out["schema"] = "columnar-1"
+
+    # Stop capturing and attach the logs for this sample, including the
+    # tool output collected on the per-sample descriptor
+    logging.getLogger().removeHandler(sample_log)
+    os.close(tool_fd)
+    with open(tool_log_fp, "rt") as f:
+        out["logs"] = sample_log.lines + f.read().splitlines()
+
+    # Return the results, to be written out by the caller
+    return out
 
-    # Write out the final results as a JSON object to the output folder
-    return_results(out, output_fp, temp_folder)
+
+# The HUMAnN2 output files to collect: file suffix, key used in the
+# results, and the column names used to parse each file
+HUMANN2_OUTPUTS = [
+    ("_genefamilies.tsv", "gene_families", ["gene_family", "RPK"]),
+    ("_pathabundance.tsv", "pathway_abund", ["pathway", "abund"]),
+    ("_pathcoverage.tsv", "pathway_cov", ["pathway", "cov"]),
+]
 
 
 def read_humann2_output_files(output_folder):
     """Look in a particular output folder and return the set of results."""
     out = {"results": {}}
 
-    for file in os.listdir(output_folder):
-        if file.endswith("_genefamilies.tsv"):
-            # This is the gene family abundance file
-            msg = "Multiple *_genefamily.tsv files"
-            assert "gene_families" not in out["results"], msg
-            dat = read_tsv(os.path.join(output_folder, file),
-                           header=["gene_family", "RPK"])
-            out["results"]["gene_families"] = dat
-        elif file.endswith("_pathabundance.tsv"):
-            # This is the pathway abundance file
-            msg = "Multiple *_pathabundance.tsv files"
-            assert "pathway_abund" not in out["results"], msg
-            dat = read_tsv(os.path.join(output_folder, file),
-                           header=["pathway", "abund"])
-            out["results"]["pathway_abund"] = dat
-        elif file.endswith("_pathcoverage.tsv"):
-            # This is the gene family abundance file
-            msg = "Multiple *pathcoverage.tsv files"
-            assert "pathway_cov" not in out["results"], msg
-            dat = read_tsv(os.path.join(output_folder, file),
-                           header=["pathway", "cov"])
-            out["results"]["pathway_cov"] = dat
+    # Scan the folder once, dispatching each file on its suffix;
+    # os.scandir hands back the entry name and joined path without an
+    # extra stat per entry
+    with os.scandir(output_folder) as entries:
+        for entry in entries:
+            for suffix, key, header in HUMANN2_OUTPUTS:
+                if entry.name.endswith(suffix):
+                    msg = "Multiple *{} files".format(suffix)
+                    assert key not in out["results"], msg
+                    out["results"][key] = read_tsv(
+                        entry.path,
+                        header=header,
+                        numeric=[header[1]])
+                    break
 
     # Make sure that all of the outputs were found
-    for k in ["gene_families", "pathway_abund", "pathway_cov"]:
-        assert k in out["results"]
+    for suffix, key, header in HUMANN2_OUTPUTS:
+        assert key in out["results"]
 
     return out
 
 
-def read_tsv(fp, header=None, comment_char="#", sep="\t"):
-    """Read any given TSV."""
-    out = []
-    if header is None:
-        # If no header is passed in, read the first line and use those values
-        skip_first_line = True
-        with open(fp, "rt") as f:
-            header = f.readline().rstrip("\n").lstrip('#').split(sep)
-    else:
-        skip_first_line = False
-    # Read in each line, and add it to the output
+def read_tsv(fp, header=None, comment_char="#", sep="\t", numeric=None):
+    """Read any given TSV as a dict of columns, one list per column."""
+    # Columnar output (one list per column) is far smaller than a dict
+    # per row, both in memory and in the final JSON, where the column
+    # names would otherwise be repeated for every single row.
+    # Read the whole file in one call and split it in memory, which is
+    # noticeably faster than iterating the buffered reader per line
     with open(fp, "rt") as f:
-        for ix, line in enumerate(f):
-            # If the first line was used as a header, skip it
-            if skip_first_line and ix == 0:
-                continue
-            # Skip lines starting with comment characters
-            elif line[0] == comment_char:
-                continue
-            # Skip empty lines
-            elif len(line.strip("\n")) == 0:
-                continue
-            else:
-                fields = line.rstrip("\n").split(sep)
-                assert len(fields) == len(header)
-                # Add the fields to the output as a dict
-                out.append(dict(zip(header, fields)))
+        lines = f.read().splitlines()
+    if header is None:
+        # If no header is passed in, use the values on the first line
+        header = lines[0].lstrip('#').split(sep)
+        lines = lines[1:]
+    out = {col: [] for col in header}
+    # Bind the column lists and expected width to locals once, outside
+    # the parsing loop
+    columns = [out[col] for col in header]
+    n_cols = len(header)
+    # Parse with the C-implemented csv reader, which is much faster
+    # than splitting each line in Python. QUOTE_NONE matches the old
+    # str.split() behavior: HUMAnN2 output is never quoted, and a
+    # gene-family name starting with '\"' must not swallow the rest of
+    # the row as a quoted field
+    for fields in csv.reader(lines, delimiter=sep, quoting=csv.QUOTE_NONE):
+        # Skip empty lines
+        if len(fields) == 0:
+            continue
+        # Skip lines starting with comment characters
+        elif fields[0].startswith(comment_char):
+            continue
+        assert len(fields) == n_cols
+        # Add each field to its column
+        for column, value in zip(columns, fields):
+            column.append(value)
+    # Cast any numeric columns to float, in bulk at C speed
+    if numeric is not None:
+        for col in numeric:
+            out[col] = list(map(float, out[col]))
     return out
 
 
@@ -400,6 +928,11 @@ if __name__ == "__main__":
                         type=str,
                         help="""Folder containing reference database.
                                 (Supported: s3://, ftp://, or local path).""")
+    parser.add_argument("--keep-ref-db",
+                        action="store_true",
+                        help="""Keep a reference database downloaded from
+                                S3 in the temp folder at exit, so that
+                                later invocations can reuse it.""")
     parser.add_argument("--metaphlan-db-prefix",
                         type=str,
                         default="metaphlan2/db_v20/mpa_v20_m200",
@@ -408,6 +941,16 @@ if __name__ == "__main__":
                         type=str,
                         help="""Path to place results (must end .json.gz).
                                 (Supported: s3://, or local path).""")
+    parser.add_argument("--sra-tool",
+                        type=str,
+                        default="fasterq-dump",
+                        choices=["fasterq-dump", "parallel-fastq-dump"],
+                        help="""Tool used to extract FASTQ from .sra files.""")
+    parser.add_argument("--batch-prefetch",
+                        action="store_true",
+                        help="""Download all SRA accessions with a single
+                                prefetch call before processing, instead
+                                of trying ENA first for each sample.""")
     parser.add_argument("--temp-folder",
                         type=str,
                         default='/share',
@@ -416,13 +959,17 @@ if __name__ == "__main__":
                         type=int,
                         default=1,
                         help="Number of threads to use for analysis.")
+    parser.add_argument("--fetch-workers",
+                        type=int,
+                        default=4,
+                        help="""Number of samples to download or upload
+                                concurrently while analyses run.""")
 
     args = parser.parse_args()
 
     # Set up logging
     log_fp = str(uuid.uuid4()) + '.log.txt'
-    fmt = '%(asctime)s %(levelname)-8s [run.py] %(message)s'
-    logFormatter = logging.Formatter(fmt)
+    logFormatter = logging.Formatter(LOG_FMT)
     rootLogger = logging.getLogger()
     rootLogger.setLevel(logging.INFO)
 
@@ -430,41 +977,107 @@ if __name__ == "__main__":
     fileHandler = logging.FileHandler(log_fp)
     fileHandler.setFormatter(logFormatter)
     rootLogger.addHandler(fileHandler)
+    # Also open an append-only descriptor on the same file, used to
+    # collect the output of subprocesses that bypass capture
+    LOG_FD = os.open(log_fp, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
     # Also write to STDOUT
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
     rootLogger.addHandler(consoleHandler)
 
     # Get the reference database
-    db_fp, delete_db_when_finished = get_reference_database(args.ref_db,
-                                                            args.temp_folder)
+    db_fp, delete_db_when_finished = get_reference_database(
+        args.ref_db, args.temp_folder, keep_db=args.keep_ref_db)
     logging.info("Reference database: " + db_fp)
     # Make sure that each of the two subfolders exist
     assert os.path.exists(os.path.join(db_fp, "chocophlan"))
     assert os.path.exists(os.path.join(db_fp, "uniref"))
 
-    # Make sure that the output path ends with .json.gz
-    assert args.output_fp.endswith(".json.gz"), args.output_fp
+    # Each input corresponds to a single output path
+    inputs = args.input.split(',')
+    output_fps = args.output_fp.split(',')
+    msg = "Provide the same number of inputs and outputs"
+    assert len(inputs) == len(output_fps), msg
+    # Make sure that every output path ends with .json.gz
+    for output_fp in output_fps:
+        assert output_fp.endswith(".json.gz"), output_fp
 
     logging.info("Threads: {}".format(args.threads))
 
-    # Align the input and calculate the overall abundance
+    # List the outputs that already exist on S3, one request per output
+    # folder rather than one per sample
+    logging.info("Checking for outputs that already exist")
+    s3_keys = list_existing_outputs(output_fps)
 
-    # Make a new temp folder for this analysis
-    temp_folder = os.path.join(args.temp_folder, str(uuid.uuid4()))
-    os.mkdir(temp_folder)
-    logging.info("Processing input argument: " + args.input)
-    # Run HUMAnN2
-    run(args.input,                    # ID for single sample to process
-        args.sample_name,              # Name of the sample
-        db_fp,                         # Local path to DB
-        args.ref_db,                   # URL of ref DB, used for logging
-        args.metaphlan_db_prefix,      # Rel path to MetaPhlAn database
-        args.output_fp,                # Place to put results
-        threads=args.threads,          # Number of threads
-        temp_folder=temp_folder)       # Temporary folder
-    # Delete the temporary folder
-    shutil.rmtree(temp_folder)
+    # Skip any samples whose output already exists
+    samples = []
+    for input_str, output_fp in zip(inputs, output_fps):
+        if output_exists(output_fp, s3_keys):
+            logging.info("Output already exists ({})".format(output_fp))
+        else:
+            # Make a new temp folder for this sample
+            temp_folder = os.path.join(args.temp_folder, str(uuid.uuid4()))
+            os.mkdir(temp_folder)
+            samples.append((input_str, output_fp, temp_folder))
+
+    # Optionally download all of the SRA accessions in a single prefetch
+    # call, which shares the VDB setup cost across accessions instead of
+    # paying it once per sample. This is opt-in: get_sra tries ENA first,
+    # which is usually faster, and a prefetched .sra makes it skip ENA
+    accessions = [input_str.split('/')[-1]
+                  for input_str, output_fp, temp_folder in samples
+                  if input_str.startswith('sra://')]
+    if args.batch_prefetch and len(accessions) > 0:
+        logging.info("Prefetching {} SRA accessions".format(len(accessions)))
+        acc_file = os.path.join(args.temp_folder, "accessions.txt")
+        with open(acc_file, "wt") as fo:
+            fo.write("\n".join(accessions) + "\n")
+        run_cmds(["prefetch",
+                  "--option-file", acc_file,
+                  "--max-size", "50g",
+                  "--output-directory", args.temp_folder],
+                 capture=False)
+        os.unlink(acc_file)
+
+    # Fetching reads is I/O-bound while HUMAnN2 is CPU-bound, so fetch
+    # all of the samples in a thread pool while running the analysis
+    # for each sample (in order) on the main thread. This hides the
+    # download and upload time behind the computation. Threads (rather
+    # than processes) are all that is needed here, since each fetch is
+    # a subprocess or network transfer that releases the GIL.
+    n_workers = max(1, min(args.fetch_workers, len(samples)))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        # Start fetching all of the samples up-front
+        fetch_futures = [
+            pool.submit(fetch_reads, input_str, temp_folder,
+                        args.threads, args.temp_folder, args.sra_tool)
+            for input_str, output_fp, temp_folder in samples
+        ]
+        # As each sample finishes downloading, run HUMAnN2 (serially)
+        return_futures = []
+        for (input_str, output_fp, temp_folder), f in zip(samples,
+                                                          fetch_futures):
+            input_file = f.result()
+            logging.info("Processing input argument: " + input_str)
+            # Run HUMAnN2
+            out = run(input_file,             # Local path to the reads
+                      input_str,              # ID for this sample
+                      db_fp,                  # Local path to DB
+                      args.ref_db,            # URL of ref DB, for logging
+                      args.metaphlan_db_prefix,  # Rel path to MetaPhlAn db
+                      threads=args.threads,   # Number of threads
+                      temp_folder=temp_folder)   # Temporary folder
+            # Return the results in the background while the next
+            # sample is being analyzed
+            return_futures.append(
+                pool.submit(return_results, out, output_fp, temp_folder))
+        # Wait for all of the results to be returned
+        for f in return_futures:
+            f.result()
+
+    # Delete the temporary folders
+    for input_str, output_fp, temp_folder in samples:
+        shutil.rmtree(temp_folder)
 
     # Delete the reference database
     if delete_db_when_finished: